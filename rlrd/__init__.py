@@ -13,6 +13,7 @@ import yaml
 
 from rlrd.util import partial, save_json, partial_to_dict, partial_from_dict, load_json, dump, load, git_info
 from rlrd.training import Training
+from rlrd.async_training import AsyncTraining
 import rlrd.sac
 import rlrd.sac_models_rd
 import rlrd.dcac
@@ -66,6 +67,11 @@ def run(run_cls: type = Training, checkpoint_path: str = None):
     list(iterate_episodes(run_cls, checkpoint_path))
 
 
+def run_async(run_cls: type = Training, checkpoint_path: str = None):
+    """like `run` but with the environment stepped in a separate process while the agent trains (see `AsyncTraining`, only for agents with a `rlrd.memory.Memory` such as `rlrd.sac.Agent`)"""
+    run(partial(AsyncTraining, *run_cls.args, **run_cls.keywords), checkpoint_path)
+
+
 def run_wandb(entity, project, run_id, run_cls: type = Training, checkpoint_path: str = None):
     """run and save config and stats to https://wandb.com"""
     wandb_dir = mkdtemp()  # prevent wandb from polluting the home directory
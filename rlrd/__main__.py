@@ -2,6 +2,8 @@
 
 Usage: `python -m dcac_python run dcac_python:RtacTraining Env.id=Pendulum-v0`
 
+or `python -m dcac_python run-async dcac_python:RtacTraining Env.id=Pendulum-v0` to step the environment in a separate process
+
 or `python -m dcac_python run-fs dcac_python-checkpoint-0 dcac_python:RtacTraining Env.id=Pendulum-v0`
 """
 
@@ -20,6 +22,8 @@ def parse_args(func, *a):
 
 if cmd == "run":
     run(parse_args(*args))
+elif cmd == "run-async":
+    run_async(parse_args(*args))
 elif cmd == "run-fs":
     run_fs(args[0], parse_args(*args[1:]))
 elif cmd == "run-wandb":
@@ -0,0 +1,131 @@
+import time
+from copy import copy, deepcopy
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from rlrd.memory import Memory
+from rlrd.training import Training
+from rlrd.wrappers import StatsWrapper
+
+
+def sample(*, Env, seed_val, window, shared_actor, lock, memory, counters, rounds, steps, sync_interval, start_training, training_steps, max_lag, stats_queue):
+    """Sampler process of `AsyncTraining`: steps the environment with a cpu copy of the actor and stores the transitions in the shared replay memory
+    `counters` holds (memory.idx, memory.size, environment steps, training steps), the first three are written here and the last one by the learner.
+    The sampler waits whenever the learner is more than `max_lag` training steps behind."""
+    torch.set_num_threads(1)  # leave the cpu to the learner
+    actor = deepcopy(shared_actor)
+    memory.preprocess_fn = actor.preprocess
+    state = None
+    with StatsWrapper(Env(seed_val=seed_val), window=window) as env:
+        for rnd in range(rounds):
+            for step in range(steps):
+                environment_steps, total_updates = counters[2:].tolist()
+                while (environment_steps - start_training) * training_steps - total_updates > max_lag:
+                    time.sleep(0.001)  # wait for the learner
+                    total_updates = counters[3].item()
+                if step % sync_interval == 0:
+                    with lock:
+                        actor.actor.load_state_dict(shared_actor.actor.state_dict())
+                obs, r, done, info = env.transition
+                action, state, _ = actor.act(state, obs, r, done, info, train=True)
+                memory.append(np.float32(r), np.float32(done), info, obs, action)
+                counters[0], counters[1] = memory.idx, memory.size
+                counters[2] += 1
+                env.step(action)
+            stats_queue.put(env.stats())
+
+
+@dataclass(eq=0)
+class AsyncTraining(Training):
+    """Like `Training` but the environment is stepped in a sampler process while the agent trains in this one.
+
+    The sampler stores transitions directly in the agent's replay memory (which is moved to shared memory) and acts with a copy of the actor that is updated every `sync_interval` steps.
+    The agent still does `training_steps` updates per environment step. They lag behind the sampler by at most `max_lag` updates, and the statistics of a round only contain the updates for the environment steps of that round.
+    Only agents with a `rlrd.memory.Memory` replay memory are supported (e.g. `rlrd.sac.Agent` but not `rlrd.dcac.Agent`).
+    """
+    sync_interval: int = 100  # number of training/environment steps between actor parameter updates of the sampler
+    max_lag: int = 100  # maximum number of training steps the learner can be behind the sampler
+
+    def __post_init__(self):
+        assert self.num_envs == 1, "AsyncTraining uses a single environment in the sampler process"
+        super().__post_init__()
+        assert isinstance(self.agent.memory, Memory), f"AsyncTraining requires a rlrd.memory.Memory replay memory, {type(self.agent).__module__}.{type(self.agent).__name__} uses {type(self.agent.memory).__name__}"
+
+    def share(self):
+        """Moves the replay memory into shared memory (allocating it from a first transition if necessary) and returns a shared cpu copy of the model"""
+        memory, model = self.agent.memory, self.agent.model
+        if memory.memory is None:
+            with self.Env(seed_val=self.seed) as env:
+                obs, r, done, info = env.transition
+                action, _, _ = model.act(model.reset(), obs, r, done, info)
+            obs = obs if memory.preprocess_fn is None else memory.preprocess_fn(obs)
+            memory.allocate((obs, action, np.float32(r), obs, np.float32(done)))
+        memory.share_memory()
+        return deepcopy(model).to('cpu').share_memory()
+
+    def update(self, counters, shared_actor, lock, round_end):
+        """runs the training steps that are pending given the sampler's progress (up to `round_end` environment steps) and shares the actor with the sampler every `sync_interval` updates"""
+        agent = self.agent
+        agent.memory.idx, agent.memory.size, environment_steps, _ = counters.tolist()
+        stats = []
+        while agent.environment_steps < min(environment_steps, round_end):
+            agent.environment_steps += 1
+            stats += agent.train_pending()
+            counters[3] = agent.total_updates  # the sampler waits for this (see `sample`)
+        if agent.total_updates - self.synced_updates >= self.sync_interval:
+            with lock:
+                shared_actor.actor.load_state_dict(agent.model.actor.state_dict())
+            self.synced_updates = agent.total_updates
+        return stats
+
+    def run_epoch(self):
+        stats = []
+        agent = self.agent
+        shared_actor = self.share()
+        ctx = mp.get_context('spawn')  # see `rlrd.testing.Test` for why we don't fork
+        lock = ctx.Lock()
+        stats_queue = ctx.Queue()
+        counters = torch.tensor((agent.memory.idx, agent.memory.size, agent.environment_steps, agent.total_updates)).share_memory_()
+
+        sampler_memory = copy(agent.memory)
+        sampler_memory.preprocess_fn = None  # this is bound to the learner's model, the sampler uses its own actor's
+        sampler = ctx.Process(target=sample, daemon=True, kwargs=dict(
+            Env=self.Env,
+            seed_val=self.seed + self.epoch,
+            window=self.stats_window or self.steps,
+            shared_actor=shared_actor,
+            lock=lock,
+            memory=sampler_memory,
+            counters=counters,
+            rounds=self.rounds,
+            steps=self.steps,
+            sync_interval=self.sync_interval,
+            start_training=agent.start_training,
+            training_steps=agent.training_steps,
+            max_lag=self.max_lag,
+            stats_queue=stats_queue
+        ))
+        sampler.start()
+        self.synced_updates = agent.total_updates
+        epoch_start = agent.environment_steps
+
+        for rnd in range(self.rounds):
+            t0, test = self.start_round(rnd)
+            stats_training = []
+
+            round_end = epoch_start + (rnd + 1) * self.steps
+            while agent.environment_steps < round_end:
+                environment_steps = agent.environment_steps
+                stats_training += self.update(counters, shared_actor, lock, round_end)
+                if agent.environment_steps == environment_steps:
+                    assert sampler.is_alive(), "the sampler process died"
+                    time.sleep(0.001)  # wait for the sampler
+
+            stats += self.end_round(t0, test, stats_queue.get(), stats_training),
+
+        sampler.join()
+        self.epoch += 1
+        return stats
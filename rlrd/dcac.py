@@ -2,7 +2,6 @@
 
 from copy import deepcopy
 from dataclasses import dataclass
-from functools import reduce
 import torch
 from torch.nn.functional import mse_loss
 import rlrd.sac
@@ -23,10 +22,10 @@ class Agent(rlrd.sac.Agent):
     def __post_init__(self, Env):
         with Env() as env:
             observation_space, action_space = env.observation_space, env.action_space
+            self.act_dim = action_space.shape[0]
             self.sup_obs_delay = env.obs_delay_range.stop
             self.sup_act_delay = env.act_delay_range.stop
             self.act_buf_size = self.sup_obs_delay + self.sup_act_delay - 1
-            self.old_act_buf_size = deepcopy(self.act_buf_size)
             if self.rtac:
                 self.act_buf_size = 1
 
@@ -58,7 +57,7 @@ class Agent(rlrd.sac.Agent):
         batch_size = terminals.shape[0]
 
         # value of the first augmented state:
-        values = [c(augm_obs_traj[0]).squeeze() for c in self.model.critics]
+        values = torch.stack([c(augm_obs_traj[0]) for c in self.model.critics]).squeeze(-1)  # shape = (num_critics, batchsize)
 
         # nstep_len is the number of valid transitions of the sampled sub-trajectory, not counting the first one which is always valid since we consider the action delay to be always >= 1.
         # nstep_len will be e.g. 0 in the rtrl setting (an action delay of 0 here means an action delay of 1 in the paper).
@@ -90,7 +89,7 @@ class Agent(rlrd.sac.Agent):
             augm_obs = augm_obs_traj[i]
             if i > 0:
                 act_slice = tuple(self.traj_new_actions[self.act_buf_size - i:self.act_buf_size])
-                augm_obs = augm_obs[:1] + ((act_slice + augm_obs[1][i:]), ) + augm_obs[2:]
+                augm_obs = augm_obs[:1] + (torch.cat((*act_slice, augm_obs[1][:, i * self.act_dim:]), dim=1), ) + augm_obs[2:]
             if i < self.act_buf_size:  # we don't compute the action for the last observation of the trajectory
                 new_action_distribution = self.model.actor(augm_obs)
                 # this is stored in right -> left order for replacing correctly in augm_obs:
@@ -104,11 +103,11 @@ class Agent(rlrd.sac.Agent):
 
         # We now compute the state-value estimate
         # (this can be a different position in the trajectory for each element of the batch).
-        # We expect each augmented state to be of shape (obs:tensor, act_buf:(tensor, ..., tensor), obs_del:tensor, act_del:tensor). Each tensor is batched.
+        # We expect each augmented state to be of shape (obs:tensor, act_buf:tensor, obs_del:tensor, act_del:tensor). Each tensor is batched.
         # To execute only 1 forward pass in the state-value estimator we recreate an artificially batched augmented state for this specific purpose.
 
         obs_s = torch.stack([self.traj_new_augm_obs[i + 1][0][ibatch] for ibatch, i in enumerate(nstep_len)])
-        act_s = tuple(torch.stack([self.traj_new_augm_obs[i + 1][1][iact][ibatch] for ibatch, i in enumerate(nstep_len)]) for iact in range(self.old_act_buf_size))
+        act_s = torch.stack([self.traj_new_augm_obs[i + 1][1][ibatch] for ibatch, i in enumerate(nstep_len)])
         od_s = torch.stack([self.traj_new_augm_obs[i + 1][2][ibatch] for ibatch, i in enumerate(nstep_len)])
         ad_s = torch.stack([self.traj_new_augm_obs[i + 1][3][ibatch] for ibatch, i in enumerate(nstep_len)])
         mod_augm_obs = tuple((obs_s, act_s, od_s, ad_s))
@@ -116,8 +115,8 @@ class Agent(rlrd.sac.Agent):
         with torch.no_grad():
 
             # These are the delayed state-value estimates we are looking for:
-            target_mod_val = [c(mod_augm_obs) for c in self.model_target.critics]
-            target_mod_val = reduce(torch.min, torch.stack(target_mod_val)).squeeze()  # minimum target estimate
+            target_mod_val = torch.stack([c(mod_augm_obs) for c in self.model_target.critics])
+            target_mod_val = target_mod_val.amin(0).squeeze()  # minimum target estimate
             target_mod_val = target_mod_val * (1. - terminals)
 
             # Now let us use this to compute the state-value targets of the batch of initial augmented states:
@@ -134,13 +133,13 @@ class Agent(rlrd.sac.Agent):
 
         # Now the critic loss is:
 
-        loss_critic = sum(mse_loss(v, value_target) for v in values)
+        loss_critic = mse_loss(values, value_target.expand_as(values)) * len(values)  # sum of the critics' losses
 
         # actor loss:
         # TODO: there is probably a way of merging this with the previous for loop
 
-        model_mod_val = [c(mod_augm_obs) for c in self.model_nograd.critics]
-        model_mod_val = reduce(torch.min, torch.stack(model_mod_val)).squeeze()  # minimum model estimate
+        model_mod_val = torch.stack([c(mod_augm_obs) for c in self.model_nograd.critics])
+        model_mod_val = model_mod_val.amin(0).squeeze()  # minimum model estimate
         model_mod_val = model_mod_val * (1. - terminals)
 
         loss_actor = torch.zeros(batch_size, device=self.device)
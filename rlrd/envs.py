@@ -27,10 +27,12 @@ def mujoco_py_issue_424_workaround():
 class Env(gym.Wrapper):
     """Environment class wrapping gym.Env that automatically resets and stores the last transition"""
 
-    def __init__(self, env, store_env=False):
+    def __init__(self, env, store_env=False, store_env_stride: int = 1):
         super().__init__(env)
         self.transition = (self.reset(), 0., True, {})
         self.store_env = store_env
+        self.store_env_stride = store_env_stride  # the environment state is only stored every `store_env_stride` steps
+        self._tick = 0
 
     def reset(self):
         return self.observation(self.env.reset())
@@ -40,8 +42,9 @@ class Env(gym.Wrapper):
         next_state = self.reset() if done else self.observation(next_state)
         self.transition = next_state, reward, done, info
 
-        if self.store_env:
-            info['env_state'] = pickle.dumps(get_env_state(self))
+        if self.store_env and self._tick % self.store_env_stride == 0:
+            info['env_state'] = pickle.dumps(get_env_state(self), protocol=pickle.HIGHEST_PROTOCOL)
+        self._tick += 1
 
         return self.transition
 
@@ -50,7 +53,7 @@ class Env(gym.Wrapper):
 
 
 class GymEnv(Env):
-    def __init__(self, seed_val=0, id: str = "Pendulum-v0", real_time: bool = False, frame_skip: int = 0, obs_scale: float = 0., store_env: bool = False):
+    def __init__(self, seed_val=0, id: str = "Pendulum-v0", real_time: bool = False, frame_skip: int = 0, obs_scale: float = 0., store_env: bool = False, store_env_stride: int = 1):
         env = gym.make(id)
 
         if obs_scale:
@@ -79,7 +82,7 @@ class GymEnv(Env):
         else:
             env = TupleObservationWrapper(env)
 
-        super().__init__(env, store_env=store_env)
+        super().__init__(env, store_env=store_env, store_env_stride=store_env_stride)
 
         # self.seed(seed_val)
 
@@ -127,7 +130,8 @@ class RandomDelayEnv(Env):
 def test_random_delay_env():
     env = RandomDelayEnv()
     obs = env.reset()
-    [env.step(env.action_space.sample()) for _ in range(1000)]
+    for _ in range(1000):
+        env.step(env.action_space.sample())
     obs, _, _, _ = env.step(env.action_space.sample())
     print('done')
 
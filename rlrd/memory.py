@@ -1,56 +1,184 @@
 from collections import deque
 from random import randint
-from rlrd.util import collate
+from typing import Sequence, Mapping
+
+import numpy as np
+import torch
+
+from rlrd.util import collate, cached_property
 
 
 class Memory:
+    """Replay memory storing transitions as preallocated contiguous tensors (one per leaf of the transition structure)
+    Floating point observations are stored as `obs_dtype` and converted back to float32 when sampled (integer observations, e.g. uint8 images, are stored as they are).
+    With prefetch=True on cuda, batches are gathered into pinned memory and copied asynchronously on a side stream one batch in advance (experimental)."""
     keep_reset_transitions: int = 0
 
-    def __init__(self, memory_size, batchsize, device, remove_size=100):
+    copy_stream = cached_property(lambda self: torch.cuda.Stream(self.device))  # cached properties are not pickled
+    next_batch = cached_property(lambda self: None)
+
+    def __init__(self, memory_size, batchsize, device, preprocess_fn=None, obs_dtype=torch.float16, prefetch=False):
         self.device = device
+        self.pin_memory = prefetch and torch.device(device).type == 'cuda'
         self.batchsize = batchsize
         self.capacity = memory_size
-        self.memory = []  # list is much faster to index than deque for big sizes
-        self.remove_size = remove_size
+        self.preprocess_fn = preprocess_fn  # applied to each observation before it is stored (e.g. `ActorModule.preprocess`)
+        self.obs_dtype = obs_dtype  # float16 only covers values up to 65504 in magnitude (larger observations are rejected by `write`), use torch.float32 otherwise
+        self.memory = None  # same nested structure as a transition with tensors of shape (capacity, ...) as leaves
+        self.idx = 0  # position of the next write (the memory is a ring buffer)
+        self.size = 0
 
         self.last_observation = None
         self.last_action = None
 
     def append(self, r, done, info, obs, action):
-        if self.last_observation is not None:
+        obs = obs if self.preprocess_fn is None else self.preprocess_fn(obs)
+        if self.last_observation is not None and self.keep(info):
+            self.store((self.last_observation, self.last_action, r, obs, done))
 
-            if self.keep_reset_transitions:
-                store = True
-            else:
-                # info["reset"] = True means the episode reset shouldn't be treated as a true terminal state
-                store = not info.get('TimeLimit.truncated', False) and not info.get('reset', False)
+        self.last_observation = obs
+        self.last_action = action
+        return self
 
-            if store:
-                self.memory.append((self.last_observation, self.last_action, r, obs, done))
+    def append_batch(self, rewards, dones, infos, obs, actions):
+        """Like `append` for a batch of environments stepped in lockstep (see `rlrd.vec_env.SubprocVecEnv`)"""
+        obs = obs if self.preprocess_fn is None else [self.preprocess_fn(o) for o in obs]
+        if self.last_observation is not None:
+            kept = [i for i in range(len(obs)) if self.keep(infos[i])]
+            if kept:
+                self.store_batch([(self.last_observation[i], self.last_action[i], rewards[i], obs[i], dones[i]) for i in kept])
 
         self.last_observation = obs
-        self.last_action = action
+        self.last_action = actions
+        return self
 
-        # remove old entries if necessary (delete generously so we don't have to do it often)
-        if len(self.memory) > self.capacity:
-            del self.memory[:self.capacity // self.remove_size + 1]
+    def keep(self, info):
+        # info["reset"] = True means the episode reset shouldn't be treated as a true terminal state
+        return self.keep_reset_transitions or not info.get('TimeLimit.truncated', False) and not info.get('reset', False)
+
+    def allocate(self, transition):
+        obs, action, r, next_obs, done = transition
+        self.memory = (
+            allocate(obs, self.capacity, self.obs_dtype),
+            allocate(action, self.capacity),
+            allocate(r, self.capacity),
+            allocate(next_obs, self.capacity, self.obs_dtype),
+            allocate(done, self.capacity),
+        )
+
+    def store(self, transition):
+        if self.memory is None:
+            self.allocate(transition)
+        write(self.memory, transition, self.idx)
+        self.idx = (self.idx + 1) % self.capacity  # overwrite the oldest entries once the memory is full
+        self.size = min(self.size + 1, self.capacity)
+
+    def store_batch(self, transitions):
+        """Like `store` for a sequence of transitions, with a single strided write per leaf"""
+        if self.memory is None:
+            self.allocate(transitions[0])
+        n = len(transitions)
+        slots = (self.idx + torch.arange(n)) % self.capacity
+        write(self.memory, stack(transitions), slots)
+        self.idx = (self.idx + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def share_memory(self):
+        """Moves the buffers into shared memory so that transitions stored by another process are visible in this one (see `rlrd.async_training`)
+        The buffers have to be allocated already (see `allocate`), note that `idx` and `size` are not shared."""
+        leaves(self.memory, lambda t: t.share_memory_())
         return self
 
     def __len__(self):
-        return len(self.memory)
+        return self.size
 
     def __getitem__(self, item):
-        return self.memory[item]
+        """returns the transitions at `item` (an int or a sequence of ints) as a batch"""
+        return gather(self.memory, torch.as_tensor(item).view(-1), None)
 
     def sample_indices(self):
-        return (randint(0, len(self.memory) - 1) for _ in range(self.batchsize))
+        return torch.randint(0, self.size, (self.batchsize,))
 
     def sample(self, indices=None):
-        indices = self.sample_indices() if indices is None else indices
-        batch = [self.memory[idx] for idx in indices]
-        batch = collate(batch, self.device)
+        if indices is not None or not self.pin_memory:
+            indices = self.sample_indices() if indices is None else torch.as_tensor(indices)
+            return gather(self.memory, indices, self.device)
+
+        if self.next_batch is None:
+            self.next_batch = self.prefetch()
+        torch.cuda.current_stream().wait_stream(self.copy_stream)
+        batch = self.next_batch
+        # the batch has been allocated on the copy stream, this prevents its memory from being reused before the current stream is done with it
+        leaves(batch, lambda t: t.record_stream(torch.cuda.current_stream()))
+        self.next_batch = self.prefetch()  # this copy overlaps with the training step on the current batch
         return batch
 
+    def prefetch(self):
+        with torch.cuda.stream(self.copy_stream):
+            return gather(self.memory, self.sample_indices(), self.device, pin_memory=True)
+
+
+def allocate(x, capacity, float_dtype=None):
+    """Creates a structure like `x` with uninitialized tensors of shape (capacity, *leaf.shape) as leaves
+    Floating point leaves are allocated as `float_dtype` if it is given."""
+    if isinstance(x, Sequence):
+        return type(x)(allocate(elem, capacity, float_dtype) for elem in x)
+    elif isinstance(x, Mapping):
+        return type(x)((key, allocate(x[key], capacity, float_dtype)) for key in x)
+    x = torch.from_numpy(np.asarray(x))  # numpy scalars and python numbers keep their numpy dtype (e.g. int -> int64)
+    dtype = float_dtype if float_dtype is not None and x.is_floating_point() else x.dtype
+    return torch.empty((capacity, *x.shape), dtype=dtype)
+
+
+def stack(xs):
+    """Turns a sequence of structures with numpy arrays (or scalars) as leaves into a single structure with stacked numpy arrays as leaves"""
+    x = xs[0]
+    if isinstance(x, Sequence):
+        return type(x)(stack(elems) for elems in zip(*xs))
+    elif isinstance(x, Mapping):
+        return type(x)((key, stack([elem[key] for elem in xs])) for key in x)
+    return np.stack(xs)
+
+
+def write(buffers, x, idx):
+    """Writes the leaves of `x` into the row `idx` (or the rows in the index tensor `idx`) of the corresponding leaves of `buffers` (converting them to the dtype of the buffers)"""
+    if isinstance(x, Sequence):
+        [write(b, elem, idx) for b, elem in zip(buffers, x)]
+    elif isinstance(x, Mapping):
+        [write(buffers[key], x[key], idx) for key in x]
+    else:
+        x = torch.from_numpy(np.asarray(x))
+        if x.is_floating_point() and buffers.dtype != x.dtype:
+            assert not (x.abs() > torch.finfo(buffers.dtype).max).any(), f"values out of the range of {buffers.dtype}, consider another obs_dtype"
+        buffers[idx] = x.to(buffers.dtype)
+
+
+def gather(buffers, indices, device, pin_memory=False):
+    """Selects the rows `indices` of all leaves of `buffers` (one `index_select` per leaf) and moves them to `device`
+    Half precision leaves are converted to float32 after the copy, i.e. only half the bytes are transferred.
+    With pin_memory=True the rows are gathered into pinned memory and copied with non_blocking=True, i.e. asynchronously."""
+    if isinstance(buffers, Sequence):
+        return type(buffers)(gather(b, indices, device, pin_memory) for b in buffers)
+    elif isinstance(buffers, Mapping):
+        return type(buffers)((key, gather(buffers[key], indices, device, pin_memory)) for key in buffers)
+    if not pin_memory:
+        batch = buffers.index_select(0, indices).to(device)
+    else:
+        # the pinned batch comes from Pytorch's caching host allocator which won't reuse it before the copy has finished
+        batch = torch.empty((len(indices), *buffers.shape[1:]), dtype=buffers.dtype, pin_memory=True)
+        batch = torch.index_select(buffers, 0, indices, out=batch).to(device, non_blocking=True)
+    return batch.float() if batch.dtype in (torch.float16, torch.bfloat16) else batch
+
+
+def leaves(x, f):
+    """Applies `f` to all leaves of `x`"""
+    if isinstance(x, Sequence):
+        [leaves(elem, f) for elem in x]
+    elif isinstance(x, Mapping):
+        [leaves(x[key], f) for key in x]
+    else:
+        f(x)
+
 
 class TrajMemory:
     keep_reset_transitions: int = 0
@@ -106,26 +234,37 @@ class TrajMemoryNoHidden:
         self.capacity = memory_size
         self.memory = []  # list is much faster to index than deque for big sizes
         self.history = deque(maxlen=history + 1)
+        self.histories = []  # one history per environment when used with `append_batch`
         self.remove_size = remove_size
 
     def append(self, r, done, info, obs, action):
-        self.history.append((r, obs, action))
+        self.extend(self.history, r, done, info, obs, action)
+        return self
+
+    def append_batch(self, rewards, dones, infos, obs, actions):
+        """Like `append` for a batch of environments stepped in lockstep, keeping one history per environment"""
+        if len(self.histories) != len(obs):
+            self.histories = [deque(maxlen=self.history.maxlen) for _ in obs]
+        for i in range(len(obs)):
+            self.extend(self.histories[i], rewards[i], dones[i], infos[i], obs[i], actions[i])
+        return self
+
+    def extend(self, history, r, done, info, obs, action):
+        history.append((r, obs, action))
         if not self.keep_reset_transitions and (info.get('TimeLimit.truncated', False) or info.get('reset', False)):
-            self.history.clear()
+            history.clear()
 
-        if len(self.history) == self.history.maxlen:
-            (_, *r), m, a = zip(*self.history)
+        if len(history) == history.maxlen:
+            (_, *r), m, a = zip(*history)
             self.memory.append((m, a, r, done))
 
         if done:
-            self.history.clear()
+            history.clear()
 
         # remove old entries if necessary (delete generously so we don't have to do it often)
         if len(self.memory) > self.capacity:
             del self.memory[:self.capacity // self.remove_size + 1]
 
-        return self
-
     def __len__(self):
         return len(self.memory)
 
@@ -140,3 +279,35 @@ class TrajMemoryNoHidden:
         batch = [self.memory[idx] for idx in indices]
         batch = collate(batch, self.device)
         return batch
+
+
+def test_memory():
+    def obs(i):  # nested tuple and dict observation
+        return (np.float32([i, -i]), {'img': np.uint8([i, 2 * i])}), np.int64(i)
+
+    m = Memory(5, 4, 'cpu')
+    for i in range(10):
+        m.append(np.float32(i), np.float32(0), {'TimeLimit.truncated': i == 8}, obs(i), np.float32([i]))
+    # transitions 1 to 9 without 8 (truncated) have been stored, the 5 most recent ones are left after wrapping around
+    assert len(m) == 5 and m.idx == 8 % 5
+
+    ((o_vec, o_dict), o_int), action, r, ((n_vec, n_dict), n_int), done = m[range(5)]
+    assert sorted(o_int.tolist()) == [3, 4, 5, 6, 8]  # 7 -> 8 has been dropped
+    assert o_vec.dtype == torch.float32 and o_dict['img'].dtype == torch.uint8
+    assert torch.equal(n_int, o_int + 1) and torch.equal(n_vec[:, 0], o_vec[:, 0] + 1) and torch.equal(n_dict['img'], o_dict['img'] + torch.tensor([1, 2], dtype=torch.uint8))
+    assert torch.equal(action[:, 0], o_vec[:, 0]) and torch.equal(r, o_vec[:, 0] + 1) and not done.any()
+    print('done')
+
+
+def test_memory_append_batch():
+    m = Memory(4, 2, 'cpu')
+    for step in range(3):
+        obs = [np.float32([10 * env + step]) for env in range(3)]
+        infos = [{'TimeLimit.truncated': step == 2 and env == 1} for env in range(3)]
+        m.append_batch(np.float32([o[0] for o in obs]), np.zeros(3, np.float32), infos, obs, np.float32([[env] for env in range(3)]))
+    # step 1 is written to rows 0, 1, 2, step 2 (without env 1) to rows 3, 0, i.e. across the wrap point
+    assert len(m) == 4 and m.idx == 1
+    obs, action, r, next_obs, done = m[range(4)]
+    assert obs[:, 0].tolist() == [21, 10, 20, 1] and next_obs[:, 0].tolist() == [22, 11, 21, 2]
+    assert action[:, 0].tolist() == [2, 1, 2, 0] and torch.equal(r, next_obs[:, 0])
+    print('done')
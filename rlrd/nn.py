@@ -1,3 +1,4 @@
+import math
 from copy import deepcopy
 from dataclasses import InitVar, dataclass
 
@@ -25,23 +26,41 @@ def no_grad(model):
 
 
 def exponential_moving_average(averages, values, factor):
+    averages, values = list(averages), list(values)
+    if not averages:  # the foreach ops don't accept empty lists
+        return
     with torch.no_grad():
-        for a, v in zip(averages, values):
-            a += factor * (v - a)  # equivalent to a = (1-factor) * a + factor * v
+        # a = (1-factor) * a + factor * v, for all tensors at once
+        torch._foreach_mul_(averages, 1 - factor)
+        torch._foreach_add_(averages, values, alpha=factor)
 
 
 def copy_shared(model_a):
-    """Create a deepcopy of a model but with the underlying state_dict shared. E.g. useful in combination with `no_grad`."""
-    model_b = deepcopy(model_a)
-    sda = model_a.state_dict(keep_vars=True)
-    sdb = model_b.state_dict(keep_vars=True)
-    for key in sda:
-        a, b = sda[key], sdb[key]
-        b.data = a.data  # strangely this will not make a.data and b.data the same object but their underlying data_ptr will be the same
-        assert b.storage().data_ptr() == a.storage().data_ptr()
+    """Create a deepcopy of a model but with the underlying state_dict shared. E.g. useful in combination with `no_grad`.
+    The parameters and buffers are never copied: the copy gets new Parameter objects (with their own requires_grad flag) pointing to the same storage."""
+    memo = {id(p): Parameter(p.data, requires_grad=p.requires_grad) for p in model_a.parameters()}
+    memo.update((id(b), b) for b in model_a.buffers())
+    model_b = deepcopy(model_a, memo)
+    assert all(a.data_ptr() == b.data_ptr() for a, b in zip(model_a.state_dict().values(), model_b.state_dict().values()))
     return model_b
 
 
+def normalize(x, mean, std):
+    return (x - mean) / std
+
+
+def unnormalize(x, mean, std):
+    return x * std + mean
+
+
+def update_moments(mean, mean_square, targets, beta: float):
+    """returns the new running mean, mean square and std after observing a batch of targets"""
+    new_mean = (1 - beta) * mean + beta * targets.mean(0)
+    new_mean_square = (1 - beta) * mean_square + beta * (targets * targets).mean(0)
+    new_std = (new_mean_square - new_mean * new_mean).sqrt().clamp(0.0001, 1e6)
+    return new_mean, new_mean_square, new_std
+
+
 class PopArt(Module):
     """PopArt http://papers.nips.cc/paper/6076-learning-values-across-many-orders-of-magnitude"""
 
@@ -65,18 +84,16 @@ class PopArt(Module):
         beta = max(1 / (self.updates + 1), self.beta) if self.zero_debias else self.beta
         # note that for beta = 1/self.updates the resulting mean, std would be the true mean and std over all past data
 
-        new_mean = (1 - beta) * self.mean + beta * targets.mean(0)
-        new_mean_square = (1 - beta) * self.mean_square + beta * (targets * targets).mean(0)
-        new_std = (new_mean_square - new_mean * new_mean).sqrt().clamp(0.0001, 1e6)
+        new_mean, new_mean_square, new_std = update_moments(self.mean, self.mean_square, targets, beta)
 
         # assert self.std.shape == (1,), 'this has only been tested in 1D'
 
         if self.updates >= self.start_pop:
             for layer in self.output_layers:
-                layer.weight *= (self.std / new_std)[:, None]
-                layer.bias *= self.std
-                layer.bias += self.mean - new_mean
-                layer.bias /= new_std
+                layer.weight.mul_((self.std / new_std)[:, None])
+                layer.bias.mul_(self.std)
+                layer.bias.add_(self.mean - new_mean)
+                layer.bias.div_(new_std)
 
         self.mean.copy_(new_mean)
         self.mean_square.copy_(new_mean_square)
@@ -85,16 +102,22 @@ class PopArt(Module):
         return self.normalize(targets)
 
     def normalize(self, x):
-        return (x - self.mean) / self.std
+        return normalize(x, self.mean, self.std)
 
     def unnormalize(self, x):
-        return x * self.std + self.mean
+        return unnormalize(x, self.mean, self.std)
 
     def normalize_sum(self, s):
         """normalize x.sum(1) preserving relative weightings between elements"""
         return (s - self.mean.sum()) / self.std.norm()
 
 
+def tanh_normal_log_prob(x, pre_tanh_value, normal_mean, normal_std, epsilon: float):
+    """log-probability of x = tanh(pre_tanh_value) with pre_tanh_value ~ N(normal_mean, normal_std)"""
+    normal_log_prob = -((pre_tanh_value - normal_mean) ** 2) / (2 * normal_std * normal_std) - normal_std.log() - 0.5 * math.log(2 * math.pi)
+    return normal_log_prob - torch.log(1 - x * x + epsilon)
+
+
 # noinspection PyAbstractClass
 class TanhNormal(Distribution):
     """Distribution of X ~ tanh(Z) where Z ~ N(mean, std)
@@ -114,7 +137,7 @@ class TanhNormal(Distribution):
         else:
             pre_tanh_value = (torch.log(1 + x + self.epsilon) - torch.log(1 - x + self.epsilon)) / 2
         assert x.dim() == 2 and pre_tanh_value.dim() == 2
-        return self.normal.log_prob(pre_tanh_value) - torch.log(1 - x * x + self.epsilon)
+        return tanh_normal_log_prob(x, pre_tanh_value, self.normal_mean, self.normal_std, self.epsilon)
 
     def sample(self, sample_shape=torch.Size()):
         z = self.normal.sample(sample_shape)
@@ -177,6 +200,42 @@ class SacLinear(torch.nn.Linear):
             self.bias.fill_(0.1)
 
 
+class StackedLinear(Module):
+    """`num` independent linear layers with their parameters stacked along a leading dimension so that they run as a single batched matmul
+    The input is either shared by all layers, shape = (batch, in_features), or separate, shape = (num, batch, in_features). The output shape is (num, batch, out_features)."""
+
+    def __init__(self, num, in_features, out_features):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        bound = 1 / np.sqrt(in_features)  # same initialization as torch.nn.Linear
+        self.weight = Parameter(torch.empty(num, out_features, in_features).uniform_(-bound, bound))
+        self.bias = Parameter(torch.empty(num, out_features).uniform_(-bound, bound))
+
+    def forward(self, x):
+        if x.dim() == 2:
+            return torch.einsum('noi,bi->nbo', self.weight, x) + self.bias[:, None]
+        return torch.baddbmm(self.bias[:, None], x, self.weight.transpose(1, 2))
+
+    def unstack(self):
+        """returns objects that look like the individual linear layers (e.g. for `PopArt`), their weight and bias are views into the stacked parameters"""
+        return [StackedLinearView(self, i) for i in range(len(self.weight))]
+
+
+class StackedLinearView:
+    def __init__(self, stacked, i):
+        self.stacked = stacked
+        self.i = i
+
+    @property
+    def weight(self):
+        return self.stacked.weight[self.i]
+
+    @property
+    def bias(self):
+        return self.stacked.bias[self.i]
+
+
 class BasicReLU(torch.nn.Linear):
     def forward(self, x):
         x = super().forward(x)
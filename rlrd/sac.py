@@ -1,7 +1,7 @@
 from collections import deque
 from copy import deepcopy, copy
 from dataclasses import dataclass, InitVar
-from functools import lru_cache, reduce
+from functools import lru_cache
 from itertools import chain
 import numpy as np
 import torch
@@ -13,6 +13,14 @@ from rlrd.util import cached_property, partial
 import rlrd.sac_models
 
 
+def compute_value_target(rewards, terminals, next_log_prob, next_value, reward_scale: float, entropy_scale: float, discount: float):
+    """computes the critic target with the entropy rewards predicted in a separate dimension from the normal rewards (not present in the original paper), shape = (batchsize, 2)"""
+    not_terminal = 1. - terminals
+    next_action_entropy = - not_terminal * discount * next_log_prob
+    reward_components = torch.stack((reward_scale * rewards, entropy_scale * next_action_entropy), dim=1)
+    return torch.addcmul(reward_components, not_terminal[:, None], next_value, value=discount)  # reward_components + (1 - terminals) * discount * next_value
+
+
 @dataclass(eq=0)
 class Agent:
     Env: InitVar
@@ -29,6 +37,7 @@ class Agent:
     start_training: int = 10000
     device: str = None
     training_steps: float = 1.  # training steps per environment interaction step
+    prefetch_batches: bool = False  # on cuda, copy the next replay batch to the gpu while training on the current one (experimental)
 
     model_nograd = cached_property(lambda self: no_grad(copy_shared(self.model)))
 
@@ -45,7 +54,7 @@ class Agent:
 
         self.actor_optimizer = torch.optim.Adam(self.model.actor.parameters(), lr=self.lr)
         self.critic_optimizer = torch.optim.Adam(self.model.critics.parameters(), lr=self.lr)
-        self.memory = Memory(self.memory_size, self.batchsize, device)
+        self.memory = Memory(self.memory_size, self.batchsize, device, preprocess_fn=self.model.preprocess, prefetch=self.prefetch_batches)
 
         self.outputnorm = self.OutputNorm(self.model.critic_output_layers)
         self.outputnorm_target = self.OutputNorm(self.model_target.critic_output_layers)
@@ -58,15 +67,32 @@ class Agent:
         if train:
             self.memory.append(np.float32(r), np.float32(done), info, obs, action)
             self.environment_steps += 1
+            stats += self.train_pending()
+        return action, next_state, stats
+
+    def act_batch(self, state, obs, r, done, info, train=False):
+        """like `act` but for a batch of environments (e.g. `rlrd.vec_env.SubprocVecEnv`) with one forward pass of the actor for all of them"""
+        stats = []
+        state = self.model.reset() if state is None else state  # initialize state if necessary
+        action, next_state, _ = self.model.act_batch(state, obs, r, done, info, train)
 
-            total_updates_target = (self.environment_steps - self.start_training) * self.training_steps
-            while self.total_updates < int(total_updates_target):
-                if self.total_updates == 0:
-                    print("starting training")
-                stats += self.train(),
-                self.total_updates += 1
+        if train:
+            self.memory.append_batch(np.asarray(r, np.float32), np.asarray(done, np.float32), info, obs, action)
+            self.environment_steps += len(obs)
+            stats += self.train_pending()
         return action, next_state, stats
 
+    def train_pending(self):
+        """runs as many training steps as needed to keep up with `training_steps` per environment step"""
+        stats = []
+        total_updates_target = (self.environment_steps - self.start_training) * self.training_steps
+        while self.total_updates < int(total_updates_target):
+            if self.total_updates == 0:
+                print("starting training")
+            stats += self.train(),
+            self.total_updates += 1
+        return stats
+
     def train(self):
         obs, actions, rewards, next_obs, terminals = self.memory.sample()  # sample a transition from the replay buffer
         new_action_distribution = self.model.actor(obs)  # outputs distribution object
@@ -75,24 +101,17 @@ class Agent:
         # critic loss
         next_action_distribution = self.model_nograd.actor(next_obs)  # outputs distribution object
         next_actions = next_action_distribution.sample()  # samples
-        next_value = [c(next_obs, next_actions) for c in self.model_target.critics]
-        next_value = reduce(torch.min, next_value)  # minimum action-value
+        next_value = self.model_target.critics_vec(next_obs, next_actions).amin(0)  # minimum action-value
         next_value = self.outputnorm_target.unnormalize(next_value)  # PopArt (not present in the original paper)
         # next_value = self.outputnorm.unnormalize(next_value)  # PopArt (not present in the original paper)
 
-        # predict entropy rewards in a separate dimension from the normal rewards (not present in the original paper)
-        next_action_entropy = - (1. - terminals) * self.discount * next_action_distribution.log_prob(next_actions)
-        reward_components = torch.cat((
-            self.reward_scale * rewards[:, None],
-            self.entropy_scale * next_action_entropy[:, None],
-        ), dim=1)  # shape = (batchsize, reward_components)
-
-        value_target = reward_components + (1. - terminals[:, None]) * self.discount * next_value
+        next_log_prob = next_action_distribution.log_prob(next_actions)
+        value_target = compute_value_target(rewards, terminals, next_log_prob, next_value, self.reward_scale, self.entropy_scale, self.discount)
         normalized_value_target = self.outputnorm.update(value_target)  # PopArt update and normalize
 
-        values = [c(obs, actions) for c in self.model.critics]
+        values = self.model.critics_vec(obs, actions)
         assert values[0].shape == normalized_value_target.shape and not normalized_value_target.requires_grad
-        loss_critic = sum(mse_loss(v, normalized_value_target) for v in values)
+        loss_critic = mse_loss(values, normalized_value_target.expand_as(values)) * len(values)  # sum of the critics' losses
 
         # update critic
         self.critic_optimizer.zero_grad()
@@ -100,8 +119,7 @@ class Agent:
         self.critic_optimizer.step()
 
         # actor loss
-        new_value = [c(obs, new_actions) for c in self.model.critics]  # new_actions with reparametrization trick
-        new_value = reduce(torch.min, new_value)  # minimum action_values
+        new_value = self.model.critics_vec(obs, new_actions).amin(0)  # new_actions with reparametrization trick, minimum action_values
         assert new_value.shape == (self.batchsize, 2)
 
         new_value = self.outputnorm.unnormalize(new_value)
@@ -24,16 +24,33 @@ class ActorModule(Module):
         """Initialize the hidden state. This will be collated before being fed to the actual model and thus should be a structure of numpy arrays rather than torch tensors."""
         return np.array(())  # just so we don't get any errors when collating and partitioning
 
+    def preprocess(self, obs):
+        """Transforms a single observation into the input format of the actor and critics. This is applied once per observation (when acting and when storing it in the replay memory) rather than on every batch."""
+        return obs
+
     def act(self, state, obs, r, done, info, train=False):
         """allows this module to be used with gym.Env
         converts inputs to torch tensors and converts outputs to numpy arrays"""
-        obs = collate([obs], device=self.device)
-        with torch.no_grad():
+        obs = collate([self.preprocess(obs)], device=self.device)
+        with torch.inference_mode():  # cheaper than no_grad, the actions are converted to numpy arrays anyway
             action_distribution = self.actor(obs)
             action = action_distribution.sample() if train else action_distribution.sample_deterministic()
         action, = partition(action)
         return action, state, []
 
+    def critics_vec(self, obs, action):
+        """evaluates all critics and stacks their outputs along a new leading dimension, shape = (num_critics, batchsize, ...)"""
+        return torch.stack([c(obs, action) for c in self.critics])
+
+    def act_batch(self, state, obs, r, done, info, train=False):
+        """like `act` but for a batch of environments, `obs` contains one observation per environment
+        returns an array of actions with one row per environment"""
+        obs = collate([self.preprocess(o) for o in obs], device=self.device)
+        with torch.inference_mode():
+            action_distribution = self.actor(obs)
+            action = action_distribution.sample() if train else action_distribution.sample_deterministic()
+        return partition(action), state, []
+
 
 class MlpActionValue(Sequential):
     def __init__(self, dim_obs, dim_action, hidden_units):
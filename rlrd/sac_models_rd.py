@@ -1,27 +1,30 @@
 import gym
+import numpy as np
 import torch
 
-from torch.nn import Linear, Sequential, ReLU, ModuleList, Module
-from torch.nn import functional as F
+from torch.nn import Linear, Sequential, ReLU, Module
 from rlrd.sac_models import ActorModule
-from rlrd.nn import TanhNormalLayer
+from rlrd.nn import TanhNormalLayer, StackedLinear
 
 from rlrd.envs import RandomDelayEnv
 
 
 class DelayedMlpModule(Module):
-    def __init__(self, observation_space, action_space, is_Q_network, hidden_units: int = 256, obs_delay=True, act_delay=True, tbmdp=False):  # FIXME: action_space param is useless
+    is_Q_network: bool  # if True, the input of forward() expects the action to be appended at the end of the input
+
+    def __init__(self, observation_space, action_space, hidden_units: int = 256, obs_delay=True, act_delay=True, tbmdp=False):
         """
+        Base class of DelayedMlpModuleQ and DelayedMlpModulePi. The input of forward() is a batch of preprocessed observations (see preprocess()), with the action appended for Q networks.
+
         Args:
             observation_space:
                 Tuple((
                     obs_space,  # most recent observation
-                    Tuple([act_space] * (obs_delay_range.stop + act_delay_range.stop)),  # action buffer
+                    Box(shape=((obs_delay_range.stop + act_delay_range.stop - 1) * act_dim,)),  # action buffer (concatenated actions)
                     Discrete(obs_delay_range.stop),  # observation delay int64
                     Discrete(act_delay_range.stop),  # action delay int64
                 ))
             action_space
-            is_Q_network: bool: if True, the input of forward() expects the action to be appended at the end of the input
             hidden_units: number of output units of this module
             (optional) obs_delay: bool (default True): if False, the observation delay of observation_space will be ignored (e.g. unknown)
             (optional) act_delay: bool (default True): if False, the action delay of observation_space will be ignored (e.g. unknown)
@@ -31,106 +34,100 @@ class DelayedMlpModule(Module):
         # TODO: check that x is actually in:
         # Tuple((
         # 	obs_space,  # most recent observation
-        # 	Tuple([act_space] * (obs_delay_range.stop + act_delay_range.stop)),  # action buffer
+        # 	Box(shape=((obs_delay_range.stop + act_delay_range.stop - 1) * act_dim,)),  # action buffer (concatenated actions)
         # 	Discrete(obs_delay_range.stop),  # observation delay int64
         # 	Discrete(act_delay_range.stop),  # kappa int64
         #   Discrete(act_delay_range.stop+1),  # beta int64 (not used by the model)
         # ))
 
         self.tbmdp = tbmdp
-        self.is_Q_network = is_Q_network
         self.act_delay = act_delay
         self.obs_delay = obs_delay
 
         self.obs_dim = observation_space[0].shape[0]
-        self.buf_size = len(observation_space[1])
+        self.act_dim = action_space.shape[0]
+        self.buf_size = observation_space[1].shape[0] // self.act_dim
         # print(f"DEBUG: MLP self.buf_size: {self.buf_size}")
-        self.act_dim = observation_space[1][0].shape[0]
-        assert self.act_dim == action_space.shape[0], f"action spaces mismatch: {self.act_dim} and {action_space.shape[0]}"
-
-        if self.is_Q_network:
-            if self.tbmdp:
-                self.lin = Linear(self.obs_dim + self.act_dim, hidden_units)
-            elif self.act_delay and self.obs_delay:
-                self.lin = Linear(self.obs_dim + (self.act_dim + 2) * self.buf_size + self.act_dim, hidden_units)
-            elif self.act_delay or self.obs_delay:
-                self.lin = Linear(self.obs_dim + (self.act_dim + 1) * self.buf_size + self.act_dim, hidden_units)
-            else:
-                self.lin = Linear(self.obs_dim + self.act_dim * self.buf_size + self.act_dim, hidden_units)
-        else:
-            if self.tbmdp:
-                self.lin = Linear(self.obs_dim, hidden_units)
-            elif self.act_delay and self.obs_delay:
-                self.lin = Linear(self.obs_dim + (self.act_dim + 2) * self.buf_size, hidden_units)
-            elif self.act_delay or self.obs_delay:
-                self.lin = Linear(self.obs_dim + (self.act_dim + 1) * self.buf_size, hidden_units)
-            else:
-                self.lin = Linear(self.obs_dim + self.act_dim * self.buf_size, hidden_units)
-
-    def forward(self, x):
-        assert isinstance(x, tuple), f"x is not a tuple: {x}"
+        assert observation_space[1].shape == (self.buf_size * self.act_dim,), f"action buffer {observation_space[1].shape} doesn't match action space {action_space.shape}"
+
+        # the input of self.lin is [obs | act_buf | obs_one_hot | act_one_hot | act] (parts that are not used have size 0)
+        # preprocess() writes these parts (except for the action) at the following positions
+        sizes = (
+            self.obs_dim,
+            0 if self.tbmdp else self.act_dim * self.buf_size,
+            self.buf_size if self.obs_delay and not self.tbmdp else 0,
+            self.buf_size if self.act_delay and not self.tbmdp else 0,
+            self.act_dim if self.is_Q_network else 0,
+        )
+        slices = []
+        self.in_dim = 0
+        for size in sizes:
+            slices.append(slice(self.in_dim, self.in_dim + size))
+            self.in_dim += size
+        self.obs_slice, self.act_buf_slice, self.obs_del_slice, self.act_del_slice, self.act_slice = slices
+        self.lin = Linear(self.in_dim, hidden_units)
+
+    def preprocess(self, x):
+        """writes the parts of a single augmented observation x that are used by the model into a flat numpy array (without the action for Q networks)
+        This is done only once per observation (e.g. when it is stored in the replay memory), forward() expects a batch of these arrays."""
         # TODO: check that x is actually in:
         # Tuple((
         # 	obs_space,  # most recent observation
-        # 	Tuple([act_space] * (obs_delay_range.stop + act_delay_range.stop)),  # action buffer
+        # 	Box(shape=((obs_delay_range.stop + act_delay_range.stop - 1) * act_dim,)),  # action buffer (concatenated actions)
         # 	Discrete(obs_delay_range.stop),  # observation delay int64
         # 	Discrete(act_delay_range.stop),  # kappa int64
         #   Discrete(act_delay_range.stop+1),  # beta int64 (not used by the model)
         # ))
-
-        # TODO: double check that everything is correct (dims, devices, autograd)
-        # TODO: triple check devices...
-
-        obs = x[0]
+        assert isinstance(x, tuple), f"x is not a tuple: {x}"
+        input = np.zeros(self.act_slice.start, np.float32)
+        input[self.obs_slice] = x[0]
 
         if self.tbmdp:
-            input = obs
-            if self.is_Q_network:
-                act = x[5]
-                input = torch.cat((input, act), dim=1)
-            h = self.lin(input)
-            return h
-
-        act_buf = torch.cat(x[1], dim=1)
+            return input
 
-        input = torch.cat((obs, act_buf), dim=1)
+        input[self.act_buf_slice] = x[1]
 
-        batch_size = obs.shape[0]
         if self.obs_delay:
-            obs_del = x[2]
-            obs_one_hot = torch.zeros(batch_size, self.buf_size, device=input.device).scatter_(1, obs_del.unsqueeze(1).long(), 1.0)
-            input = torch.cat((input, obs_one_hot), dim=1)
+            input[self.obs_del_slice.start + x[2]] = 1.  # one-hot
         if self.act_delay:
-            act_del = x[3]
-            act_one_hot = torch.zeros(batch_size, self.buf_size, device=input.device).scatter_(1, act_del.unsqueeze(1).long(), 1.0)
-            input = torch.cat((input, act_one_hot), dim=1)
-        if self.is_Q_network:
-            act = x[5]
-            input = torch.cat((input, act), dim=1)
+            input[self.act_del_slice.start + x[3]] = 1.  # one-hot
+        return input
 
-        h = self.lin(input)
+    def forward(self, x):
+        return self.lin(x)
 
-        return h
 
+class DelayedMlpModuleQ(DelayedMlpModule):
+    is_Q_network = True
 
-class MlpActionValue(Sequential):
-    def __init__(self, observation_space, action_space, hidden_units, act_delay=True, obs_delay=True, tbmdp=False):
+
+class DelayedMlpModulePi(DelayedMlpModule):
+    is_Q_network = False
+
+
+class VectorizedMlpCritics(Sequential):
+    """`num_critics` action-value networks evaluated together, each layer runs once for all critics (see `StackedLinear`)
+    The output shape is (num_critics, batchsize, 2)."""
+
+    def __init__(self, observation_space, action_space, hidden_units, num_critics, act_delay=True, obs_delay=True, tbmdp=False):
+        input_module = DelayedMlpModuleQ(observation_space, action_space, hidden_units, act_delay=act_delay, obs_delay=obs_delay, tbmdp=tbmdp)
+        input_module.lin = StackedLinear(num_critics, input_module.in_dim, hidden_units)  # the input is the same for all critics
         super().__init__(
-            DelayedMlpModule(observation_space, action_space, is_Q_network=True, act_delay=act_delay, obs_delay=obs_delay, tbmdp=tbmdp), ReLU(),
-            Linear(hidden_units, hidden_units), ReLU(),
-            Linear(hidden_units, 2)  # reward and entropy predicted separately
+            input_module, ReLU(),
+            StackedLinear(num_critics, hidden_units, hidden_units), ReLU(),
+            StackedLinear(num_critics, hidden_units, 2)  # reward and entropy predicted separately
         )
 
     # noinspection PyMethodOverriding
     def forward(self, obs, action):
-        x = (*obs, action)
+        x = torch.cat((obs, action), dim=1)
         return super().forward(x)
 
 
 class MlpPolicy(Sequential):
     def __init__(self, observation_space, action_space, hidden_units, act_delay=True, obs_delay=True, tbmdp=False):
         super().__init__(
-            DelayedMlpModule(observation_space, action_space, is_Q_network=False, act_delay=act_delay, obs_delay=obs_delay, tbmdp=tbmdp), ReLU(),
+            DelayedMlpModulePi(observation_space, action_space, act_delay=act_delay, obs_delay=obs_delay, tbmdp=tbmdp), ReLU(),
             Linear(hidden_units, hidden_units), ReLU(),
             TanhNormalLayer(hidden_units, action_space.shape[0])
         )
@@ -141,9 +138,19 @@ class MlpPolicy(Sequential):
 
 
 class Mlp(ActorModule):
-    def __init__(self, observation_space, action_space, hidden_units: int = 256, num_critics: int = 2, act_delay: bool = True, obs_delay: bool = True, tbmdp: bool = False):
+    def __init__(self, observation_space, action_space, hidden_units: int = 256, num_critics: int = 2, act_delay: bool = True, obs_delay: bool = True, tbmdp: bool = False, use_torch_compile: bool = False):
         super().__init__()
         assert isinstance(observation_space, gym.spaces.Tuple)
-        self.critics = ModuleList(MlpActionValue(observation_space, action_space, hidden_units, act_delay=act_delay, obs_delay=obs_delay, tbmdp=tbmdp) for _ in range(num_critics))
+        self.critics = VectorizedMlpCritics(observation_space, action_space, hidden_units, num_critics, act_delay=act_delay, obs_delay=obs_delay, tbmdp=tbmdp)
         self.actor = MlpPolicy(observation_space, action_space, hidden_units, act_delay=act_delay, obs_delay=obs_delay, tbmdp=tbmdp)
-        self.critic_output_layers = [c[-1] for c in self.critics]
+        self.critic_output_layers = self.critics[-1].unstack()
+        if use_torch_compile:
+            # compiling in place (rather than wrapping with torch.compile) keeps parameter names and indexing like critics[-1] intact
+            self.actor.compile(mode="reduce-overhead")
+            self.critics.compile()
+
+    def critics_vec(self, obs, action):
+        return self.critics(obs, action)
+
+    def preprocess(self, obs):
+        return self.actor[0].preprocess(obs)
@@ -9,9 +9,10 @@ from pandas import DataFrame, Timestamp
 import rlrd.sac
 
 from rlrd.testing import Test
-from rlrd.util import pandas_dict, cached_property
+from rlrd.util import pandas_dict, cached_property, partial
 from rlrd.wrappers import StatsWrapper
 from rlrd.envs import GymEnv
+from rlrd.vec_env import SubprocVecEnv, stats_env
 # from dcac_python.batch_env import get_env_state
 
 # import pybullet_envs
@@ -28,44 +29,61 @@ class Training:
     stats_window: int = None  # default = steps, should be at least as long as a single episode
     seed: int = 0  # seed is currently not used
     tag: str = ''  # for logging, e.g. allows to compare groups of runs
+    num_envs: int = 1  # number of training environments, if > 1 they are stepped in parallel worker processes and share the steps of each round
 
     def __post_init__(self):
+        assert self.steps % self.num_envs == 0, f"steps ({self.steps}) has to be a multiple of num_envs ({self.num_envs})"
         self.epoch = 0
         self.agent = self.Agent(self.Env)
 
+    def make_env(self):
+        window = self.stats_window or self.steps
+        if self.num_envs == 1:
+            return StatsWrapper(self.Env(seed_val=self.seed + self.epoch), window=window)
+        # each environment only sees 1 / num_envs of the steps
+        seeds = range(self.seed + self.epoch * self.num_envs, self.seed + (self.epoch + 1) * self.num_envs)
+        return SubprocVecEnv([partial(stats_env, self.Env, seed_val=seed, window=window // self.num_envs) for seed in seeds])
+
+    def start_round(self, rnd):
+        """prints the round header and starts the test of the current actor, which runs in parallel to the training process"""
+        print(f"=== epoch {self.epoch + 1}/{self.epochs} ".ljust(20, '=') + f" round {rnd + 1}/{self.rounds} ".ljust(50, '='))
+        t0 = pd.Timestamp.utcnow()
+        test = self.Test(
+            Env=self.Env,
+            actor=self.agent.model,
+            steps=self.stats_window or self.steps,
+            base_seed=self.seed + self.epochs
+        )
+        return t0, test
+
+    def end_round(self, t0, test, env_stats, stats_training):
+        """combines the environment, test and training statistics of a round and prints them"""
+        stats = pandas_dict(
+            **env_stats,
+            round_time=Timestamp.utcnow() - t0,
+            **test.stats().add_suffix("_test"),  # this blocks until the tests have finished
+            round_time_total=Timestamp.utcnow() - t0,
+            **DataFrame(stats_training).mean(skipna=True)
+        )
+        print(stats.add_prefix("  ").to_string(), '\n')
+        return stats
+
     def run_epoch(self):
         stats = []
         state = None
+        act = self.agent.act if self.num_envs == 1 else self.agent.act_batch
 
-        with StatsWrapper(self.Env(seed_val=self.seed + self.epoch), window=self.stats_window or self.steps) as env:
+        with self.make_env() as env:
             for rnd in range(self.rounds):
-                print(f"=== epoch {self.epoch + 1}/{self.epochs} ".ljust(20, '=') + f" round {rnd + 1}/{self.rounds} ".ljust(50, '='))
-
-                t0 = pd.Timestamp.utcnow()
+                t0, test = self.start_round(rnd)
                 stats_training = []
 
-                # start test and run it in parallel to the training process
-                test = self.Test(
-                    Env=self.Env,
-                    actor=self.agent.model,
-                    steps=self.stats_window or self.steps,
-                    base_seed=self.seed + self.epochs
-                )
-
-                for step in range(self.steps):
-                    action, state, training_stats = self.agent.act(state, *env.transition, train=True)
+                for step in range(self.steps // self.num_envs):
+                    action, state, training_stats = act(state, *env.transition, train=True)
                     stats_training += training_stats
                     env.step(action)
 
-                stats += pandas_dict(
-                    **env.stats(),
-                    round_time=Timestamp.utcnow() - t0,
-                    **test.stats().add_suffix("_test"),  # this blocks until the tests have finished
-                    round_time_total=Timestamp.utcnow() - t0,
-                    **DataFrame(stats_training).mean(skipna=True)
-                ),
-
-                print(stats[-1].add_prefix("  ").to_string(), '\n')
+                stats += self.end_round(t0, test, env.stats(), stats_training),
 
         self.epoch += 1
         return stats
@@ -0,0 +1,104 @@
+import multiprocessing as mp
+
+import numpy as np
+
+from rlrd.wrappers import StatsWrapper
+
+
+def worker(conn, env_fn):
+    """Runs a single environment in a subprocess and executes the commands sent by `SubprocVecEnv`"""
+    env = env_fn()
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == 'step':
+                conn.send(env.step(data))  # `rlrd.envs.Env` resets automatically at the end of an episode
+            elif cmd == 'transition':
+                conn.send(env.transition)
+            elif cmd == 'stats':
+                conn.send(env.stats())
+            elif cmd == 'close':
+                break
+            else:
+                raise AttributeError("Undefined command: " + cmd)
+    finally:
+        env.close()
+        conn.close()
+
+
+def stats_env(Env, seed_val, window):
+    return StatsWrapper(Env(seed_val=seed_val), window=window)
+
+
+class SubprocVecEnv:
+    """Steps a batch of environments in lockstep, each one in its own worker process.
+
+    Like `rlrd.envs.Env`, the last transition is stored in `transition` as (obs, rewards, dones, infos) where `obs` and `infos` are tuples with one element per environment and `rewards` and `dones` are arrays.
+    """
+
+    def __init__(self, env_fns):
+        ctx = mp.get_context('spawn')  # see `rlrd.testing.Test` for why we don't fork
+        self.conns, worker_conns = zip(*(ctx.Pipe() for _ in env_fns))
+        self.processes = [ctx.Process(target=worker, args=(conn, env_fn), daemon=True) for conn, env_fn in zip(worker_conns, env_fns)]
+        [p.start() for p in self.processes]
+        [conn.close() for conn in worker_conns]  # these are only used by the workers
+        self.transition = self.collect(self.request('transition'))
+        self.closed = False
+
+    def __len__(self):
+        return len(self.conns)
+
+    def request(self, cmd, data=None):
+        """sends `cmd` to all workers (with one element of `data` per worker) and returns their answers"""
+        data = [None] * len(self) if data is None else data
+        [conn.send((cmd, d)) for conn, d in zip(self.conns, data)]
+        return [conn.recv() for conn in self.conns]
+
+    @staticmethod
+    def collect(transitions):
+        obs, rewards, dones, infos = zip(*transitions)
+        return obs, np.array(rewards, np.float32), np.array(dones, np.float32), infos
+
+    def step(self, actions):
+        self.transition = self.collect(self.request('step', actions))
+        return self.transition
+
+    def stats(self):
+        """averages the statistics of all environments (they have to be wrapped in `rlrd.wrappers.StatsWrapper`, e.g. with `stats_env`)"""
+        stats = self.request('stats')
+        return {k: np.sum([s[k] for s in stats]) if k == 'episodes' else np.nanmean([s[k] for s in stats]) for k in stats[0]}
+
+    def close(self):
+        if not self.closed:
+            [conn.send(('close', None)) for conn in self.conns]
+            [p.join() for p in self.processes]
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def test_subproc_vec_env(Env=None, steps=100):
+    import rlrd.sac
+    import rlrd.sac_models_rd
+    from rlrd.envs import RandomDelayEnv
+    from rlrd.util import partial
+    Env = Env or RandomDelayEnv
+    agent = rlrd.sac.Agent(Env, device='cpu', batchsize=16, start_training=20, memory_size=1000, Model=rlrd.sac_models_rd.Mlp)
+    state, stats = None, []
+    with SubprocVecEnv([partial(stats_env, Env, seed_val=seed, window=steps) for seed in range(2)]) as env:
+        for step in range(steps):
+            action, state, training_stats = agent.act_batch(state, *env.transition, train=True)
+            stats += training_stats
+            env.step(action)
+        env_stats = env.stats()
+    assert agent.environment_steps == 2 * steps and len(agent.memory) > steps and stats
+    assert set(env_stats) >= {'episodes', 'returns', 'average_reward'}
+    print('done')
+
+
+if __name__ == '__main__':
+    test_subproc_vec_env()
@@ -1,9 +1,10 @@
+from bisect import bisect
 from collections import deque
-from random import sample
+from random import randrange, random
 import itertools
 
 import gym
-from gym.spaces import Tuple, Discrete
+from gym.spaces import Tuple, Discrete, Box
 
 import numpy as np
 
@@ -29,9 +30,10 @@ class RandomDelayWrapper(gym.Wrapper):
         self.obs_delay_range = obs_delay_range
         self.act_delay_range = act_delay_range
 
+        buf_size = obs_delay_range.stop + act_delay_range.stop - 1
         self.observation_space = Tuple((
             env.observation_space,  # most recent observation
-            Tuple([env.action_space] * (obs_delay_range.stop + act_delay_range.stop - 1)),  # action buffer
+            Box(np.tile(env.action_space.low, buf_size), np.tile(env.action_space.high, buf_size), dtype=env.action_space.dtype),  # action buffer (buf_size actions concatenated)
             Discrete(obs_delay_range.stop),  # observation delay int64
             Discrete(act_delay_range.stop),  # action delay int64
         ))
@@ -123,7 +125,7 @@ class RandomDelayWrapper(gym.Wrapper):
         Simulates the time at which it will reach the agent and stores it on the left of self.arrival_times_actions
         """
         # at the brain
-        kappa, = sample(self.act_delay_range, 1) if not init else [0, ]  # TODO: change this if we implement a different initialization
+        kappa = randrange(self.act_delay_range.start, self.act_delay_range.stop) if not init else 0  # TODO: change this if we implement a different initialization
         self.arrival_times_actions.appendleft(self.t + kappa)
         self.past_actions.appendleft(action)
 
@@ -149,7 +151,7 @@ class RandomDelayWrapper(gym.Wrapper):
         Simulates the time at which it will reach the brain and appends it in self.arrival_times_observations
         """
         # at the remote actor
-        alpha, = sample(self.obs_delay_range, 1)
+        alpha = randrange(self.obs_delay_range.start, self.obs_delay_range.stop)
         self.arrival_times_observations.appendleft(self.t + alpha)
         self.past_observations.appendleft(obs)
 
@@ -160,7 +162,7 @@ class RandomDelayWrapper(gym.Wrapper):
         Returns:
             augmented_obs: tuple:
                 m: object: last observation that reached the brain
-                past_actions: tuple: the history of actions that the brain sent so far
+                past_actions: np.ndarray: the history of actions that the brain sent so far (concatenated, most recent first)
                 alpha: int: number of micro time steps it took the last observation to travel from the agent/observer to the brain
                 kappa: int: action travel delay + number of micro time-steps for which the next action has been applied at the agent
                 beta: int: action travel delay + number of micro time-steps for which the previous action has been applied at the agent
@@ -171,7 +173,7 @@ class RandomDelayWrapper(gym.Wrapper):
         # at the brain
         alpha = next(i for i, t in enumerate(self.arrival_times_observations) if t <= self.t)
         m, r, d, info, kappa, beta = self.past_observations[alpha]
-        return (m, tuple(itertools.islice(self.past_actions, 0, self.past_actions.maxlen - 1)), alpha, kappa, beta), r, d, info
+        return (m, np.concatenate(tuple(itertools.islice(self.past_actions, 0, self.past_actions.maxlen - 1))), alpha, kappa, beta), r, d, info
 
 
 class UnseenRandomDelayWrapper(RandomDelayWrapper):
@@ -185,20 +187,22 @@ class UnseenRandomDelayWrapper(RandomDelayWrapper):
         self.observation_space = env.observation_space
 
     def reset(self, **kwargs):
-        t = super().reset(**kwargs)  # t: (m, tuple(self.past_actions), alpha, kappa, beta)
+        t = super().reset(**kwargs)  # t: (m, past_actions, alpha, kappa, beta)
         return t[0]
 
     def step(self, action):
-        t, *aux = super().step(action)  # t: (m, tuple(self.past_actions), alpha, kappa, beta)
+        t, *aux = super().step(action)  # t: (m, past_actions, alpha, kappa, beta)
         return (t[0], *aux)
 
 
-def simple_wifi_sampler1():
-    return np.random.choice([1, 2, 3, 4, 5, 6], p=[0.3082, 0.5927, 0.0829, 0.0075, 0.0031, 0.0056])
+def categorical_sampler(values, p):
+    """returns a function sampling from `values` with probabilities `p` (much cheaper per call than np.random.choice)"""
+    cdf = list(itertools.accumulate(p))
+    return lambda: values[min(bisect(cdf, random() * cdf[-1]), len(values) - 1)]
 
 
-def simple_wifi_sampler2():
-    return np.random.choice([1, 2, 3, 4], p=[0.3082, 0.5927, 0.0829, 0.0162])
+simple_wifi_sampler1 = categorical_sampler([1, 2, 3, 4, 5, 6], p=[0.3082, 0.5927, 0.0829, 0.0075, 0.0031, 0.0056])
+simple_wifi_sampler2 = categorical_sampler([1, 2, 3, 4], p=[0.3082, 0.5927, 0.0829, 0.0162])
 
 
 class WifiDelayWrapper1(RandomDelayWrapper):